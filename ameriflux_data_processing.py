@@ -3,7 +3,8 @@ ameriflux_data_processing.py
 Key Features:
 2. Extract relevant columns for processing.
 4. Handle missing date values by substituting GROUP_ID as a replacement.
-- Load the Excel file containing AmeriFlux BASE data.
+- Load the Excel file containing AmeriFlux BASE data, reusing a cached copy of the
+  extracted columns when the Excel file has not changed since the last run.
 - Filter the dataset to include only relevant columns: SITE_ID, GROUP_ID, VARIABLE_GROUP, VARIABLE, and DATAVALUE.
 - Extract and organize date information for each GROUP_ID.
 - Process each VARIABLE_GROUP independently:
@@ -18,7 +19,10 @@ Output:
 - Each CSV file is structured with GROUP_ID, date columns, and other variables.
 Dependencies:
 - pandas: For data manipulation and processing.
+- numpy: For ordering rows by position.
+- openpyxl: For streaming rows out of the Excel workbook.
 - os: For directory and file handling.
+- concurrent.futures: For processing and writing VARIABLE_GROUPs in parallel.
 Usage:
 - Update the `file_path` variable with the correct path to the AmeriFlux BASE Excel file.
 - Run the script to process the data and generate CSV files in the "processed_data" directory.
@@ -42,100 +46,148 @@ Steps:
 This script ensures efficient data transformation for biomass and soil research.
 """
 
+import concurrent.futures
+import os
+from operator import itemgetter
+
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
+from pandas._libs.parsers import STR_NA_VALUES
 
 # Load the Excel file
 file_path = "./AMF_US-Ne1_BIF_20230922.xlsx"  # Update with the correct file path
-df = pd.read_excel(file_path, sheet_name="AMF-BIF")
-
-# Extract relevant columns
-df_filtered = df[["SITE_ID", "GROUP_ID", "VARIABLE_GROUP", "VARIABLE", "DATAVALUE"]]
 
-# Create a dictionary to store date information by GROUP_ID
-date_info = {}
+# Reuse the columns extracted on a previous run unless the Excel file has changed since.
+# Bump CACHE_VERSION whenever the cached columns or their dtypes change, so older caches are ignored.
+CACHE_VERSION = 3
+cache_path = os.path.splitext(file_path)[0] + ".filtered.pkl"
+df_filtered = None
+if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+    try:
+        cached = pd.read_pickle(cache_path)
+    except Exception:
+        cached = None
+    if isinstance(cached, dict) and cached.get("version") == CACHE_VERSION:
+        df_filtered = cached["data"]
 
-# Process date information first
-date_rows = df_filtered[df_filtered["VARIABLE"].str.contains("DATE", na=False)]
-for _, row in date_rows.iterrows():
-    group_id = row["GROUP_ID"]
-    variable = row["VARIABLE"]
-    value = row["DATAVALUE"]
+if df_filtered is None:
+    # Stream the sheet in read-only mode instead of building the full styled-cell workbook
+    wb = load_workbook(file_path, read_only=True, data_only=True)
+    ws = wb["AMF-BIF"]
+    header = next(ws.iter_rows(max_row=1, values_only=True))
+    
+    # Pad every row to the header width; without a <dimension> tag, openpyxl drops trailing empty cells
+    rows = ws.iter_rows(min_row=2, max_col=len(header), values_only=True)
+    
+    # Extract relevant columns while streaming, so other cells never reach pandas
+    columns = ["SITE_ID", "GROUP_ID", "VARIABLE_GROUP", "VARIABLE", "DATAVALUE"]
+    pick_columns = itemgetter(*[header.index(col) for col in columns])
+    
+    # Treat the same text markers as missing that pd.read_excel does ("NA", "N/A", "NULL", ...)
+    def pick_row(row):
+        return tuple(
+            None if isinstance(value, str) and value in STR_NA_VALUES else value
+            for value in pick_columns(row)
+        )
     
-    if group_id not in date_info:
-        date_info[group_id] = {}
+    df_filtered = pd.DataFrame(map(pick_row, rows), columns=columns)
+    wb.close()
     
-    date_info[group_id][variable] = value
+    # Store the low-cardinality key columns as categories so grouping works on integer codes
+    df_filtered = df_filtered.astype(
+        {col: "category" for col in ["SITE_ID", "GROUP_ID", "VARIABLE_GROUP", "VARIABLE"]}
+    )
+    try:
+        pd.to_pickle({"version": CACHE_VERSION, "data": df_filtered}, cache_path)
+    except OSError as e:
+        print(f"Could not write cache file {cache_path}: {e}")
+
+# Flag date variables once for the whole dataset
+is_date = df_filtered["VARIABLE"].str.contains("DATE", na=False, regex=False)
+
+# Process date information first: one row per GROUP_ID, one column per date variable.
+# Rows without a GROUP_ID cannot be matched to a record, so they are left out.
+date_rows = df_filtered[is_date & df_filtered["GROUP_ID"].notna()]
+df_dates = (
+    date_rows.drop_duplicates(["GROUP_ID", "VARIABLE"], keep="last")
+    .set_index(["GROUP_ID", "VARIABLE"])["DATAVALUE"]
+    .unstack("VARIABLE")
+)
+
+# Positions of each GROUP_ID's date rows, so a group picks up every date recorded for its GROUP_IDs
+date_positions = date_rows.groupby("GROUP_ID", sort=False, observed=True).indices
+
+# Convert each distinct GROUP_ID to a number once, for sorting the output rows
+distinct_group_ids = pd.Index(df_filtered["GROUP_ID"].dropna().unique()).astype(object)
+group_id_numbers = pd.Series(pd.to_numeric(distinct_group_ids, errors="coerce"), index=distinct_group_ids)
 
 # Create a directory to store output files
 output_dir = "processed_data"
 os.makedirs(output_dir, exist_ok=True)
 
-# Process each VARIABLE_GROUP separately
-for group in df_filtered["VARIABLE_GROUP"].unique():
-    print(f"Processing {group}...")
+
+def process_group(group, positions):
+    """Pivot one VARIABLE_GROUP to a row per GROUP_ID and save it as a CSV file."""
+    # Take the rows of this variable group by position
+    df_group = df_filtered.iloc[positions]
+    
+    # Get unique GROUP_IDs for this variable group, in order of first appearance
+    first_seen_ids = df_group["GROUP_ID"].unique()
+    
+    # Sort the GROUP_IDs by their numeric value for the output rows
+    group_numbers = group_id_numbers.reindex(first_seen_ids).sort_values(kind="stable")
+    group_ids = pd.Index(group_numbers.index, name="GROUP_ID")
+    
+    # Date columns cover every date recorded for these GROUP_IDs, in order of first appearance
+    group_date_positions = [date_positions[gid] for gid in first_seen_ids if gid in date_positions]
+    date_cols = []
+    if group_date_positions:
+        date_cols = date_rows["VARIABLE"].iloc[np.concatenate(group_date_positions)].unique()
     
-    # Filter data for the current group
-    df_group = df_filtered[df_filtered["VARIABLE_GROUP"] == group]
+    # Separate the other variables of this group, reusing the dataset-wide date flags;
+    # rows without a GROUP_ID belong to no record
+    is_value = ~is_date.iloc[positions].to_numpy()
+    is_value &= df_group["GROUP_ID"].notna().to_numpy()
+    value_rows = df_group[is_value]
     
-    # Get unique GROUP_IDs for this variable group
-    group_ids = df_group["GROUP_ID"].unique()
+    # Order variable columns by first appearance, walking the GROUP_IDs in order of first appearance
+    group_id_codes = pd.factorize(df_group["GROUP_ID"])[0][is_value]
+    value_cols = value_rows["VARIABLE"].iloc[np.argsort(group_id_codes, kind="stable")].unique()
     
-    # Create a list to store processed rows
-    processed_rows = []
+    # Pivot non-date variables to one row per GROUP_ID, one column per variable;
+    # a repeated variable keeps its last value
+    df_values = (
+        value_rows.drop_duplicates(["GROUP_ID", "VARIABLE"], keep="last")
+        .set_index(["GROUP_ID", "VARIABLE"])["DATAVALUE"]
+        .unstack("VARIABLE")
+        .reindex(columns=value_cols)
+    )
     
-    for group_id in group_ids:
-        # Get data for this GROUP_ID
-        df_id = df_group[df_group["GROUP_ID"] == group_id]
-        
-        # Create a dictionary for this row
-        row_dict = {"GROUP_ID": group_id}
-        
-        # Add date information if available
-        if group_id in date_info:
-            for date_var, date_val in date_info[group_id].items():
-                row_dict[date_var] = date_val
-        
-        # Add non-date variables
-        for _, row in df_id[~df_id["VARIABLE"].str.contains("DATE", na=False, regex=True)].iterrows():
-            variable = row["VARIABLE"]
-            value = row["DATAVALUE"]
-            row_dict[variable] = value
-        
-        # Add to processed rows
-        processed_rows.append(row_dict)
+    # Put GROUP_ID first, followed by date columns, then other variables
+    result_df = df_dates.reindex(index=group_ids, columns=date_cols).join(df_values)
     
-    # Create DataFrame from processed rows
-    if processed_rows:
-        result_df = pd.DataFrame(processed_rows)
-        
-        # Reorder columns to put GROUP_ID first, followed by date columns, then other variables
-        cols = ["GROUP_ID"]
-        date_cols = [col for col in result_df.columns if "DATE" in col]
-        other_cols = [col for col in result_df.columns if col != "GROUP_ID" and col not in date_cols]
-        
-        # Combine columns in the desired order
-        ordered_cols = cols + date_cols + other_cols
-        
-        # Filter to only include columns that actually exist in the DataFrame
-        ordered_cols = [col for col in ordered_cols if col in result_df.columns]
-        
-        # Reorder columns
-        result_df = result_df[ordered_cols]
-        
-        # Sort by GROUP_ID
-        try:
-            result_df["GROUP_ID"] = pd.to_numeric(result_df["GROUP_ID"], errors='coerce')
-            result_df.sort_values(by="GROUP_ID", inplace=True)
-            result_df["GROUP_ID"] = result_df["GROUP_ID"].fillna(0).astype(int).astype(str)
-        except:
-            result_df.sort_values(by="GROUP_ID", inplace=True)
-        
-        # Write to CSV
-        output_file = os.path.join(output_dir, f"{group}.csv")
-        result_df.to_csv(output_file, index=False)
-        print(f"  - Created {output_file} with {len(result_df)} rows and {len(result_df.columns)} columns")
-    else:
-        print(f"  - No data to process for {group}")
+    # Write GROUP_ID in its numeric form, using 0 where it is not numeric
+    result_df.index = pd.Index(group_numbers.fillna(0).astype(int), name="GROUP_ID")
+    result_df = result_df.reset_index()
+    
+    # Give each column the dtype it would get from its values alone, so numbers are written consistently
+    result_df = result_df.infer_objects()
+    
+    # Write to CSV through a large buffer to cut down on write calls
+    output_file = os.path.join(output_dir, f"{group}.csv")
+    with open(output_file, "w", encoding="utf-8", newline="", buffering=4 * 1024 * 1024) as f:
+        result_df.to_csv(f, index=False, lineterminator="\n", chunksize=50_000)
+    return f"  - Created {output_file} with {len(result_df)} rows and {len(result_df.columns)} columns"
+
+
+# Partition the row positions by VARIABLE_GROUP in a single pass, then process the groups in parallel
+groups = df_filtered.groupby("VARIABLE_GROUP", sort=False, observed=True).indices
+with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    results = executor.map(process_group, groups.keys(), groups.values())
+    for group, message in zip(groups, results):
+        print(f"Processing {group}...")
+        print(message)
 
 print(f"\nProcessing complete. Results saved to the '{output_dir}' directory.")
 